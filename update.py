@@ -15,6 +15,7 @@
 # limitations under the License.
 #
 import argparse
+from contextlib import contextmanager
 import logging
 import os
 from pathlib import Path
@@ -22,18 +23,22 @@ import shutil
 import subprocess
 from tempfile import TemporaryDirectory
 import textwrap
+from typing import Callable, Iterator, Optional
 
 
 THIS_DIR = Path(__file__).resolve().parent
 
+ARTIFACT_PATTERN = "android-ndk-*.zip"
+
 
 def logger():
     return logging.getLogger(__name__)
 
 
-def check_call(cmd):
-    logger().debug("Running `%s`", " ".join(cmd))
-    subprocess.check_call(cmd)
+def check_call(cmd, cwd=None, input_bytes=None):
+    if logger().isEnabledFor(logging.DEBUG):
+        logger().debug("Running `%s`", " ".join(str(arg) for arg in cmd))
+    subprocess.run(cmd, cwd=cwd, input=input_bytes, check=True)
 
 
 def remove(path):
@@ -41,8 +46,10 @@ def remove(path):
     os.remove(path)
 
 
-def fetch_artifact(branch: str, build: str, pattern: str) -> None:
-    """Fetches an artifact from the build server.
+def start_fetch_artifact(
+    branch: str, build: str, pattern: str, cwd: Path
+) -> subprocess.Popen:
+    """Starts fetching an artifact from the build server.
 
     Use OAuth2 authentication and the gLinux android-fetch-artifact package,
     which work with both on-corp and off-corp workstations."""
@@ -64,7 +71,63 @@ def fetch_artifact(branch: str, build: str, pattern: str) -> None:
         build,
         pattern,
     ]
-    check_call(cmd)
+    if logger().isEnabledFor(logging.DEBUG):
+        logger().debug("Starting `%s`", " ".join(cmd))
+    return subprocess.Popen(cmd, cwd=cwd)
+
+
+@contextmanager
+def fetching_release(
+    branch: str, build: str, cache_dir: Optional[Path]
+) -> Iterator[Callable[[], Path]]:
+    """Fetches the NDK release artifact while the body of the with block runs.
+
+    Yields a function that waits for the fetch and returns the path to the artifact. If
+    the body raises before the fetch has finished, the fetch is killed rather than
+    waited for.
+
+    The artifact is fetched into a scratch directory that is deleted when the block
+    exits. With a cache directory the artifact is moved into the cache once the fetch
+    completes, so an interrupted fetch never leaves a truncated artifact behind. Build
+    numbers are never reused by the build server, so a cached artifact is used as-is.
+    """
+    if cache_dir is None:
+        build_cache = None
+        scratch_parent = THIS_DIR
+    else:
+        build_cache = cache_dir / branch / build
+        cached = list(build_cache.glob(ARTIFACT_PATTERN))
+        if cached:
+            logger().info("Using cached artifact from %s", build_cache)
+            assert len(cached) == 1
+            yield lambda: cached[0]
+            return
+        build_cache.mkdir(parents=True, exist_ok=True)
+        scratch_parent = build_cache
+
+    logger().info(
+        "Fetching %s from %s (artifacts matching %s)", build, branch, ARTIFACT_PATTERN
+    )
+    with TemporaryDirectory(dir=scratch_parent) as temp_dir:
+        download_dir = Path(temp_dir)
+        fetch = start_fetch_artifact(branch, build, ARTIFACT_PATTERN, download_dir)
+
+        def wait_for_artifact() -> Path:
+            if fetch.wait() != 0:
+                raise subprocess.CalledProcessError(fetch.returncode, fetch.args)
+            artifacts = list(download_dir.glob(ARTIFACT_PATTERN))
+            assert len(artifacts) == 1
+            if build_cache is None:
+                return artifacts[0]
+            return artifacts[0].rename(build_cache / artifacts[0].name)
+
+        try:
+            yield wait_for_artifact
+        finally:
+            if fetch.poll() is None:
+                logger().info("Cancelling fetch")
+                fetch.kill()
+                fetch.wait()
 
 
 def api_str(api_level):
@@ -74,13 +137,13 @@ def api_str(api_level):
 def start_branch(build):
     branch_name = "update-" + (build or "latest")
     logger().info("Creating branch %s", branch_name)
-    check_call(["repo", "start", branch_name, "."])
+    check_call(["repo", "start", branch_name, "."], cwd=THIS_DIR)
 
 
 def remove_old_release(install_dir: Path) -> None:
     if (install_dir / ".git").exists():
         logger().info('Removing old install directory "%s"', install_dir)
-        check_call(["git", "rm", "-rf", install_dir])
+        check_call(["git", "rm", "-rf", install_dir], cwd=THIS_DIR)
 
     # Need to check again because git won't remove directories if they have
     # non-git files in them.
@@ -100,11 +163,27 @@ LIBANDROID_SUPPORT_GLOB = (
     "toolchains/llvm/prebuilt/linux-x86_64/sysroot/usr/lib/*/libandroid_support.a"
 )
 
+# Where Soong expects to find the prebuilt libc++ libraries, relative to the install.
+LIBCXX_LIBS_DIR = "sources/cxx-stl/llvm-libc++/libs"
+
+TRIPLE_TO_ABI = {
+    "arm-linux-androideabi": "armeabi-v7a",
+    "aarch64-linux-android": "arm64-v8a",
+    "i686-linux-android": "x86",
+    "x86_64-linux-android": "x86_64",
+}
+CLANG_ARCH_TO_ABI = {
+    "arm": "armeabi-v7a",
+    "aarch64": "arm64-v8a",
+    "i386": "x86",
+    "x86_64": "x86_64",
+}
+
 
 def unzip_single_directory(artifact: Path, destination: Path) -> None:
-    # Use cwd so that we can use rename without having to worry about crossing
-    # file systems.
-    with TemporaryDirectory(dir=os.getcwd()) as temp_dir:
+    # Extract next to the destination so that we can use rename without having to
+    # worry about crossing file systems.
+    with TemporaryDirectory(dir=destination.parent) as temp_dir:
         cmd = [
             "unzip",
             str(artifact),
@@ -120,14 +199,17 @@ def unzip_single_directory(artifact: Path, destination: Path) -> None:
             os.path.join("*", LIBCXX_STATIC_GLOB),
             os.path.join("*", LIBCXXABI_GLOB),
             os.path.join("*", LIBANDROID_SUPPORT_GLOB),
+            # The install doesn't keep any Android.mk files.
+            "-x",
+            "*/Android.mk",
         ]
         check_call(cmd)
 
         dirs = os.listdir(temp_dir)
         assert len(dirs) == 1
         ndk_dir = Path(temp_dir) / dirs[0]
-        for child in ndk_dir.iterdir():
-            child.rename(destination / child.name)
+        # destination must not exist; remove_old_release guarantees that.
+        ndk_dir.rename(destination)
 
 
 def relocate_libcxx(install_dir: Path) -> None:
@@ -138,76 +220,51 @@ def relocate_libcxx(install_dir: Path) -> None:
     find them in that directory though. We could fix Soong, but since this whole
     directory should be dead soon we'll just fix-up the install for now.
     """
-    dest_base = install_dir / "sources/cxx-stl/llvm-libc++/libs"
-    for glob in {
+    dest_base = install_dir / LIBCXX_LIBS_DIR
+    lib_globs = (
         LIBCXX_SHARED_GLOB,
         LIBCXX_STATIC_GLOB,
         LIBCXXABI_GLOB,
         LIBANDROID_SUPPORT_GLOB,
-    }:
-        file_name = Path(glob).name
-        for file_path in install_dir.glob(glob):
-            triple = file_path.parent.name
-            abi = {
-                "arm-linux-androideabi": "armeabi-v7a",
-                "aarch64-linux-android": "arm64-v8a",
-                "i686-linux-android": "x86",
-                "x86_64-linux-android": "x86_64",
-            }[triple]
-            dest_dir = dest_base / abi
-            dest_dir.mkdir(parents=True, exist_ok=True)
-            dest = dest_dir / file_name
+    )
+    # All of the libraries live directly in the same per-triple directories, so each
+    # of those only needs to be listed once.
+    triple_dirs_glob = str(Path(LIBCXX_SHARED_GLOB).parent)
+    assert all(str(Path(glob).parent) == triple_dirs_glob for glob in lib_globs)
+    file_names = {Path(glob).name for glob in lib_globs}
+    for triple_dir in install_dir.glob(triple_dirs_glob):
+        abi = TRIPLE_TO_ABI[triple_dir.name]
+        dest_dir = dest_base / abi
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        for file_path in triple_dir.iterdir():
+            if file_path.name not in file_names:
+                continue
+            dest = dest_dir / file_path.name
             logger().info("Relocating %s to %s", file_path, dest)
             file_path.rename(dest)
 
 
 def relocate_libunwind(install_dir: Path) -> None:
-    dest_base = install_dir / "sources/cxx-stl/llvm-libc++/libs"
+    dest_base = install_dir / LIBCXX_LIBS_DIR
     for libunwind in install_dir.glob(LIBUNWIND_GLOB):
         arch = libunwind.parent.name
-        abi = {
-            "arm": "armeabi-v7a",
-            "aarch64": "arm64-v8a",
-            "i386": "x86",
-            "x86_64": "x86_64",
-        }[arch]
+        abi = CLANG_ARCH_TO_ABI[arch]
         dest_dir = dest_base / abi
         dest = dest_dir / "libunwind.a"
         logger().info("Relocating %s to %s", libunwind, dest)
         libunwind.rename(dest)
 
 
-def delete_android_mks(install_dir: Path) -> None:
-    for android_mk in install_dir.glob("**/Android.mk"):
-        android_mk.unlink()
-
-
-def install_new_release(branch: str, build: str, install_dir: Path) -> None:
-    install_dir.mkdir()
-
-    artifact_pattern = "android-ndk-*.zip"
-    logger().info(
-        "Fetching %s from %s (artifacts matching %s)", build, branch, artifact_pattern
-    )
-    fetch_artifact(branch, build, artifact_pattern)
-    artifacts = list(Path().glob("android-ndk-*.zip"))
-    try:
-        assert len(artifacts) == 1
-        artifact = artifacts[0]
-
-        logger().info("Extracting release")
-        unzip_single_directory(artifact, install_dir)
-        relocate_libcxx(install_dir)
-        relocate_libunwind(install_dir)
-        delete_android_mks(install_dir)
-    finally:
-        for artifact in artifacts:
-            artifact.unlink()
+def install_new_release(artifact: Path, install_dir: Path) -> None:
+    logger().info("Extracting release")
+    unzip_single_directory(artifact, install_dir)
+    relocate_libcxx(install_dir)
+    relocate_libunwind(install_dir)
 
 
 def commit(branch: str, build: str, install_dir: Path) -> None:
     logger().info("Making commit")
-    check_call(["git", "add", str(install_dir)])
+    check_call(["git", "add", str(install_dir)], cwd=THIS_DIR)
     message = textwrap.dedent(
         f"""\
         Update NDK prebuilts to build {build}.
@@ -218,7 +275,13 @@ def commit(branch: str, build: str, install_dir: Path) -> None:
         Test: treehugger
         """
     )
-    check_call(["git", "commit", "-m", message])
+    # Pass the message on stdin rather than in argv so it never needs quoting and
+    # isn't bound by the argument length limit.
+    check_call(
+        ["git", "commit", "-F", "-"],
+        cwd=THIS_DIR,
+        input_bytes=message.encode("utf-8"),
+    )
 
 
 def get_args():
@@ -232,6 +295,14 @@ def get_args():
         action="store_true",
         help="Perform the update in the current branch. Do not repo start.",
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help=(
+            "Keep downloaded artifacts in this directory and reuse them when "
+            "updating to the same branch and build again."
+        ),
+    )
     parser.add_argument(
         "-v", "--verbose", action="count", default=0, help="Increase output verbosity."
     )
@@ -239,8 +310,6 @@ def get_args():
 
 
 def main() -> None:
-    os.chdir(THIS_DIR)
-
     args = get_args()
     verbose_map = (logging.WARNING, logging.INFO, logging.DEBUG)
     verbosity = min(args.verbose, 2)
@@ -248,10 +317,16 @@ def main() -> None:
 
     install_dir = THIS_DIR / "current"
 
-    if not args.use_current_branch:
-        start_branch(args.build)
-    remove_old_release(install_dir)
-    install_new_release(args.branch, args.build, install_dir)
+    # The fetch only creates files in its own scratch directory, under THIS_DIR or the
+    # cache directory, and never touches current/. Let it run while the branch is
+    # created and the old release is removed; if either fails, the fetch is killed
+    # instead of waited for.
+    with fetching_release(args.branch, args.build, args.cache_dir) as wait_for_artifact:
+        if not args.use_current_branch:
+            start_branch(args.build)
+        remove_old_release(install_dir)
+        install_new_release(wait_for_artifact(), install_dir)
+
     commit(args.branch, args.build, install_dir)
 
 